@@ -1,24 +1,62 @@
 """
-LangGraph-based Exam Grading Agent using Gemini (Official Google SDK)
+Exam Grading Agent using Gemini (Official Google SDK)
 File: grading_agent.py
 """
 import os
 import base64
-from typing import TypedDict, List
-from langgraph.graph import StateGraph, END
+import asyncio
+import functools
+import hashlib
+import random
+import re
+from typing import List
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+import numpy as np
+import simplejpeg
 from PIL import Image, ImageDraw, ImageFont
 from django.conf import settings
+from django.core.cache import cache
 import io
 
+# How long grading results are kept in the cache (re-grades and demo
+# runs with identical papers/instructions skip Gemini entirely)
+GRADE_CACHE_TIMEOUT = 60 * 60 * 24
 
-class GradingState(TypedDict):
-    """State for the grading workflow"""
-    images: List[bytes]  # List of image bytes
-    instructions: str
-    current_index: int
-    grades: List[dict]  # List of {image_bytes, grade, feedback}
-    error: str
+# Longest side of the copy sent to Gemini; the model reads handwriting
+# fine at this size and smaller uploads cut request latency
+GEMINI_MAX_DIMENSION = 1536
+
+# Grading prompt template, built once instead of per call
+GRADING_PROMPT = """You are an expert teacher grading exam papers.
+Analyze this exam paper image carefully and provide:
+1. A numerical grade/score (e.g., 85/100, 92/100, or appropriate format)
+2. Brief feedback on the student's performance
+
+Additional Instructions from Teacher: {instructions}
+
+Be fair, constructive, and professional in your evaluation.
+
+Provide your response in the following format:
+GRADE: [score]
+FEEDBACK: [your brief feedback]"""
+
+# Transient Gemini failures worth retrying; anything else fails the paper
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,    # 429
+    google_exceptions.InternalServerError,  # 500
+    google_exceptions.ServiceUnavailable,   # 503
+    google_exceptions.DeadlineExceeded,
+)
+
+# Exponential backoff schedule for those retries
+GEMINI_MAX_ATTEMPTS = 5
+GEMINI_BACKOFF_BASE = 1.0   # seconds, doubled per attempt
+GEMINI_BACKOFF_MAX = 30.0
+
+# Single-pass parse of "GRADE: ... FEEDBACK: ..." responses; the
+# FEEDBACK part is optional to match how malformed replies were handled
+RESPONSE_PATTERN = re.compile(r"GRADE:\s*(.*?)\s*(?:FEEDBACK:\s*(.*))?\Z", re.DOTALL)
 
 
 class ExamGradingAgent:
@@ -27,182 +65,237 @@ class ExamGradingAgent:
         self.api_key = settings.GOOGLE_API_KEY
         genai.configure(api_key=self.api_key)
         self.model = genai.GenerativeModel('gemini-1.5-flash')
-        self.workflow = self._build_workflow()
-    
-    def _build_workflow(self) -> StateGraph:
-        """Build the LangGraph workflow"""
-        workflow = StateGraph(GradingState)
-        
-        # Add nodes
-        workflow.add_node("validate_input", self._validate_input)
-        workflow.add_node("grade_paper", self._grade_paper)
-        workflow.add_node("add_marks_to_image", self._add_marks_to_image)
-        workflow.add_node("next_paper", self._next_paper)
-        
-        # Add edges
-        workflow.set_entry_point("validate_input")
-        workflow.add_edge("validate_input", "grade_paper")
-        workflow.add_edge("grade_paper", "add_marks_to_image")
-        workflow.add_edge("add_marks_to_image", "next_paper")
-        
-        # Conditional edge: continue or end
-        workflow.add_conditional_edges(
-            "next_paper",
-            self._should_continue,
-            {
-                "continue": "grade_paper",
-                "end": END
-            }
-        )
-        
-        return workflow.compile()
-    
-    def _validate_input(self, state: GradingState) -> GradingState:
-        """Validate input data"""
-        if not state.get("images") or len(state["images"]) == 0:
-            state["error"] = "No images provided"
-            return state
-        
-        if "current_index" not in state:
-            state["current_index"] = 0
-        
-        if "grades" not in state:
-            state["grades"] = []
-        
-        return state
-    
-    def _grade_paper(self, state: GradingState) -> GradingState:
-        """Grade the current exam paper using Gemini Vision"""
+        self._font = self._load_font()
+        # Grade strings repeat across a batch ("Grade: 85/100" etc.), so
+        # measure each distinct one only once
+        self._text_bbox = functools.lru_cache(maxsize=128)(self._font.getbbox)
+
+    def _load_font(self) -> ImageFont.ImageFont:
+        """Load the banner font once; parsing the TTF per paper is wasted work"""
+        # Try to use a nice font, fall back to default if not available
         try:
-            current_idx = state["current_index"]
-            image_bytes = state["images"][current_idx]
-            instructions = state.get("instructions", "")
-            
-            # Load image from bytes
-            image = Image.open(io.BytesIO(image_bytes))
-            
-            # Create the grading prompt
-            prompt = f"""You are an expert teacher grading exam papers. 
-Analyze this exam paper image carefully and provide:
-1. A numerical grade/score (e.g., 85/100, 92/100, or appropriate format)
-2. Brief feedback on the student's performance
+            return ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 40)
+        except:
+            try:
+                return ImageFont.truetype("arial.ttf", 40)
+            except:
+                return ImageFont.load_default()
 
-Additional Instructions from Teacher: {instructions if instructions else 'None'}
+    async def grade_papers_stream(self, images: List[bytes], instructions: str = ""):
+        """
+        Grade exam papers concurrently, yielding results as they finish
 
-Be fair, constructive, and professional in your evaluation.
+        Yields one dict per paper in completion order:
+        {'index', 'success', 'grade', 'feedback', 'image_bytes'} on
+        success, or {'index', 'success', 'error'} when that paper failed.
+        """
+        # Cap in-flight Gemini calls so a big batch does not trip the
+        # provider's rate limit; created here so it binds to this loop
+        semaphore = asyncio.Semaphore(getattr(settings, 'GEMINI_MAX_CONCURRENCY', 8))
 
-Provide your response in the following format:
-GRADE: [score]
-FEEDBACK: [your brief feedback]"""
-            
-            # Call Gemini with vision - pass content as a list
-            response = self.model.generate_content(
-                contents=[prompt, image],
-                generation_config=genai.GenerationConfig(
-                    temperature=0.3,
-                )
+        # Fan out: one task per paper, at most GEMINI_MAX_CONCURRENCY
+        # Gemini calls actually in flight
+        tasks = [
+            asyncio.create_task(self._grade_indexed(idx, image_bytes, instructions, semaphore))
+            for idx, image_bytes in enumerate(images)
+        ]
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+
+    async def _grade_indexed(self, current_idx: int, image_bytes: bytes, instructions: str,
+                             semaphore: asyncio.Semaphore) -> dict:
+        """Grade one paper and stamp its banner, keeping failures per-paper"""
+        try:
+            grade_info = await self._grade_one(image_bytes, instructions, semaphore)
+        except Exception as e:
+            return {
+                "index": current_idx,
+                "success": False,
+                "error": f"Error grading paper {current_idx}: {str(e)}"
+            }
+
+        error = self._add_marks_to_image(grade_info, current_idx)
+        if error:
+            return {
+                "index": current_idx,
+                "success": False,
+                "error": error
+            }
+
+        return {
+            "index": current_idx,
+            "success": True,
+            "grade": grade_info["grade"],
+            "feedback": grade_info["feedback"],
+            "image_bytes": grade_info["image_bytes"]
+        }
+
+    @staticmethod
+    def _decode_image(image_bytes: bytes) -> np.ndarray:
+        """Decode an uploaded image to an RGB pixel array
+
+        Done once per paper; grading and mark drawing both work from the
+        same array instead of decoding the bytes twice.
+        """
+        # libjpeg-turbo (SIMD) - much faster than PIL's JPEG path; the
+        # fast DCT/upsampling modes are plenty accurate for scanned paper
+        if image_bytes[:3] == b'\xff\xd8\xff':
+            return simplejpeg.decode_jpeg(
+                image_bytes,
+                colorspace='RGB',
+                fastdct=True,
+                fastupsample=True
             )
-            result_text = response.text
-            
-            # Parse the response
-            grade = "N/A"
-            feedback = result_text
-            
-            if "GRADE:" in result_text:
-                parts = result_text.split("FEEDBACK:")
-                grade_part = parts[0].replace("GRADE:", "").strip()
-                grade = grade_part
-                if len(parts) > 1:
-                    feedback = parts[1].strip()
-            
-            # Store the grading result
-            state["grades"].append({
-                "image_bytes": image_bytes,
+
+        # Non-JPEG uploads (e.g. PNG) still go through PIL; close the
+        # buffer and image promptly instead of leaving them to the GC
+        with io.BytesIO(image_bytes) as buffer:
+            with Image.open(buffer) as image:
+                return np.array(image.convert('RGB'))
+
+    @staticmethod
+    def _image_from_pixels(pixels: np.ndarray) -> Image.Image:
+        """Wrap a contiguous RGB array as a PIL image
+
+        Goes straight through frombuffer, skipping fromarray's dtype and
+        shape introspection on the array interface.
+        """
+        height, width = pixels.shape[:2]
+        return Image.frombuffer('RGB', (width, height), pixels, 'raw', 'RGB', 0, 1)
+
+    @staticmethod
+    def _grade_cache_key(image_bytes: bytes, instructions: str) -> str:
+        """Cache key for one (paper, instructions) grading call"""
+        image_digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+        instructions_digest = hashlib.sha1(instructions.encode()).hexdigest()
+        return f"grade:{image_digest}:{instructions_digest}"
+
+    async def _generate_with_retry(self, contents: list):
+        """Call Gemini, retrying transient 429/5xx errors with backoff
+
+        Only the flaky call is retried; a paper that keeps failing raises
+        and is reported on its own, without sinking the rest of the batch.
+        """
+        for attempt in range(GEMINI_MAX_ATTEMPTS):
+            try:
+                return await self.model.generate_content_async(
+                    contents=contents,
+                    generation_config=genai.GenerationConfig(
+                        temperature=0.3,
+                    )
+                )
+            except RETRYABLE_ERRORS:
+                if attempt == GEMINI_MAX_ATTEMPTS - 1:
+                    raise
+                # Jitter spreads a whole batch's retries apart
+                delay = min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * (2 ** attempt))
+                await asyncio.sleep(delay * (0.5 + random.random() / 2))
+
+    async def _grade_one(self, image_bytes: bytes, instructions: str,
+                         semaphore: asyncio.Semaphore) -> dict:
+        """Grade a single exam paper using Gemini Vision"""
+        # Single decode per paper; mark drawing reuses the same pixels
+        pixels = self._decode_image(image_bytes)
+
+        # Identical paper + instructions means an identical verdict, so
+        # skip the Gemini round-trip when we have seen this pair before
+        cache_key = self._grade_cache_key(image_bytes, instructions)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            grade, feedback = cached
+            return {
+                "pixels": pixels,
                 "grade": grade,
                 "feedback": feedback
-            })
-            
-        except Exception as e:
-            state["error"] = f"Error grading paper {current_idx}: {str(e)}"
-        
-        return state
-    
-    def _add_marks_to_image(self, state: GradingState) -> GradingState:
-        """Add grade marks to the exam paper image"""
+            }
+
+        # Downscaled copy for Gemini, resized from the decoded pixels
+        image = self._image_from_pixels(pixels)
+        image.thumbnail((GEMINI_MAX_DIMENSION, GEMINI_MAX_DIMENSION))
+
+        # Create the grading prompt
+        prompt = GRADING_PROMPT.format(instructions=instructions if instructions else 'None')
+
+        # Call Gemini with vision - pass content as a list; the semaphore
+        # slot is held across retries so backoff also throttles the batch
+        async with semaphore:
+            response = await self._generate_with_retry([prompt, image])
+        result_text = response.text
+
+        # Parse the response
+        grade = "N/A"
+        feedback = result_text
+
+        match = RESPONSE_PATTERN.search(result_text)
+        if match:
+            grade = match.group(1)
+            if match.group(2) is not None:
+                feedback = match.group(2).strip()
+
+        cache.set(cache_key, (grade, feedback), timeout=GRADE_CACHE_TIMEOUT)
+
+        return {
+            "pixels": pixels,
+            "grade": grade,
+            "feedback": feedback
+        }
+
+    def _add_marks_to_image(self, grade_info: dict, current_idx: int) -> str:
+        """Add the grade mark to a single exam paper image"""
         try:
-            current_idx = state["current_index"]
-            grade_info = state["grades"][current_idx]
-            
-            # Load image
-            image = Image.open(io.BytesIO(grade_info["image_bytes"]))
-            
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Create drawing context
-            draw = ImageDraw.Draw(image)
-            
-            # Try to use a nice font, fall back to default if not available
-            try:
-                font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 40)
-            except:
-                try:
-                    font = ImageFont.truetype("arial.ttf", 40)
-                except:
-                    font = ImageFont.load_default()
-            
+            # Pixels were already decoded during grading
+            pixels = grade_info.pop("pixels")
+
+            font = self._font
+
             # Prepare text
             grade_text = f"Grade: {grade_info['grade']}"
-            
+
             # Calculate text position (top-center)
-            bbox = draw.textbbox((0, 0), grade_text, font=font)
+            bbox = self._text_bbox(grade_text)
             text_width = bbox[2] - bbox[0]
             text_height = bbox[3] - bbox[1]
-            
-            x = (image.width - text_width) // 2
+
+            x = (pixels.shape[1] - text_width) // 2
             y = 20
-            
-            # Draw background rectangle for better visibility
+
+            # Only the banner strip at the top goes through PIL; everything
+            # below it is left untouched instead of copying the whole image
             padding = 15
+            strip_height = min(pixels.shape[0], y + text_height + padding + 3)
+            strip = self._image_from_pixels(pixels[:strip_height])
+            draw = ImageDraw.Draw(strip)
+
+            # Draw background rectangle for better visibility
             draw.rectangle(
                 [x - padding, y - padding, x + text_width + padding, y + text_height + padding],
                 fill='red',
                 outline='darkred',
                 width=3
             )
-            
+
             # Draw grade text
             draw.text((x, y), grade_text, fill='white', font=font)
-            
-            # Convert back to bytes
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='JPEG', quality=95)
-            img_byte_arr.seek(0)
-            
-            # Update the image bytes with marked version
-            state["grades"][current_idx]["image_bytes"] = img_byte_arr.getvalue()
-            
+
+            # Splice the drawn banner back into the decoded pixels
+            pixels[:strip_height] = np.asarray(strip)
+
+            # Re-encode with libjpeg-turbo; quality 85 with 4:2:0 chroma
+            # subsampling is plenty for a grade-stamped scan and roughly
+            # halves the output size vs the old quality-95 default
+            grade_info["image_bytes"] = simplejpeg.encode_jpeg(
+                pixels,
+                quality=85,
+                colorspace='RGB',
+                colorsubsampling='420',
+                fastdct=True
+            )
+
         except Exception as e:
-            state["error"] = f"Error adding marks to image {current_idx}: {str(e)}"
-        
-        return state
-    
-    def _next_paper(self, state: GradingState) -> GradingState:
-        """Move to the next paper"""
-        state["current_index"] += 1
-        return state
-    
-    def _should_continue(self, state: GradingState) -> str:
-        """Determine if we should continue grading or end"""
-        if state.get("error"):
-            return "end"
-        
-        if state["current_index"] >= len(state["images"]):
-            return "end"
-        
-        return "continue"
-    
+            return f"Error adding marks to image {current_idx}: {str(e)}"
+
+        return None
+
     def grade_papers(self, images: List[bytes], instructions: str = "") -> dict:
         """
         Grade multiple exam papers
@@ -214,28 +307,27 @@ FEEDBACK: [your brief feedback]"""
         Returns:
             dict with 'success', 'graded_images' (list of bytes), and optional 'error'
         """
-        initial_state = {
-            "images": images,
-            "instructions": instructions,
-            "current_index": 0,
-            "grades": [],
-            "error": None
-        }
-        
-        # Run the workflow
-        final_state = self.workflow.invoke(initial_state)
-        
-        if final_state.get("error"):
+        if not images:
             return {
                 "success": False,
-                "error": final_state["error"]
+                "error": "No images provided"
             }
-        
-        # Extract graded images
-        graded_images = [grade["image_bytes"] for grade in final_state["grades"]]
-        
+
+        # Buffered wrapper around the streaming path
+        async def collect():
+            return [result async for result in self.grade_papers_stream(images, instructions)]
+
+        results = sorted(asyncio.run(collect()), key=lambda r: r["index"])
+
+        for result in results:
+            if not result["success"]:
+                return {
+                    "success": False,
+                    "error": result["error"]
+                }
+
         return {
             "success": True,
-            "graded_images": graded_images,
-            "grades": [{"grade": g["grade"], "feedback": g["feedback"]} for g in final_state["grades"]]
+            "graded_images": [result["image_bytes"] for result in results],
+            "grades": [{"grade": r["grade"], "feedback": r["feedback"]} for r in results]
         }
\ No newline at end of file
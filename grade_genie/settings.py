@@ -92,3 +92,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 GOOGLE_API_KEY=''
 
+# Maximum number of Gemini calls in flight at once when grading a batch;
+# keeps the parallel fan-out under the provider's rate limit
+GEMINI_MAX_CONCURRENCY = 8
+
@@ -1,11 +1,47 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-import json
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+import orjson
 from django.shortcuts import render
 import base64
+from uuid import uuid4
 from .grading_agent import ExamGradingAgent
 
+# One agent per process: re-running genai.configure and building a new
+# GenerativeModel on every POST threw away the SDK's warm connections.
+# The model is safe to share across concurrent grading calls.
+_agent = None
+
+
+def _get_agent():
+    global _agent
+    if _agent is None:
+        _agent = ExamGradingAgent()
+    return _agent
+
+
+def _decode_base64_images(images_base64):
+    """Decode a batch of base64 images (with or without data-URL prefix) to bytes"""
+    # rpartition keeps the part after the "data:image/...;base64," prefix
+    # and returns the whole string untouched when there is no prefix
+    return [
+        base64.b64decode(img_b64.rpartition(',')[2])
+        for img_b64 in images_base64
+    ]
+
+
+def _encode_base64_image(image_bytes):
+    """Encode graded JPEG bytes as a data-URL base64 string"""
+    return 'data:image/jpeg;base64,' + base64.b64encode(image_bytes).decode('ascii')
+
+
+def _save_graded_image(image_bytes):
+    """Store a graded JPEG in media storage and return its URL path"""
+    name = default_storage.save(f'graded/{uuid4().hex}.jpg', ContentFile(image_bytes))
+    return default_storage.url(name)
+
 
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -16,71 +52,82 @@ def grade_papers(request):
     Expects:
         - images: List of base64 encoded images
         - instructions: Text with specific grading instructions
-        
+
     Returns:
+        NDJSON stream with one line per paper, in completion order:
+        - index: Position of the paper in the uploaded batch
         - success: Boolean
-        - graded_images: List of base64 encoded images with grades
-        - grades: List of grade information
-        - error: Error message if any
+        - graded_image_url: URL of the marked image in media storage
+          (with ?format=inline, a base64 graded_image field instead)
+        - grade / feedback: Grade information
+        - error: Error message if that paper failed
     """
     try:
         # Parse request data
+        image_bytes_list = []
         if request.content_type == 'application/json':
-            data = json.loads(request.body)
+            # orjson is several times faster than stdlib json on payloads
+            # full of long base64 strings
+            data = orjson.loads(request.body)
             images_base64 = data.get('images', [])
             instructions = data.get('instructions', '')
         else:
             # Handle multipart/form-data
             images_base64 = request.POST.getlist('images')
             instructions = request.POST.get('instructions', '')
-            
-            # Also check for file uploads
+
+            # File uploads are already raw bytes - no base64 round-trip
             uploaded_files = request.FILES.getlist('images')
             if uploaded_files:
                 images_base64 = []
-                for uploaded_file in uploaded_files:
-                    image_bytes = uploaded_file.read()
-                    images_base64.append(base64.b64encode(image_bytes).decode('utf-8'))
-        
+                image_bytes_list = [uploaded_file.read() for uploaded_file in uploaded_files]
+
+        # Convert base64 images to bytes
+        if images_base64:
+            image_bytes_list = _decode_base64_images(images_base64)
+
         # Validate input
-        if not images_base64 or len(images_base64) == 0:
+        if not image_bytes_list:
             return JsonResponse({
                 'success': False,
                 'error': 'No images provided'
             }, status=400)
         
-        # Convert base64 images to bytes
-        image_bytes_list = []
-        for img_b64 in images_base64:
-            # Remove data URL prefix if present
-            if ',' in img_b64:
-                img_b64 = img_b64.split(',')[1]
-            image_bytes_list.append(base64.b64decode(img_b64))
-        
-        # Initialize grading agent
-        agent = ExamGradingAgent()
-        
-        # Grade the papers
-        result = agent.grade_papers(image_bytes_list, instructions)
-        
-        if not result['success']:
-            return JsonResponse({
-                'success': False,
-                'error': result.get('error', 'Unknown error occurred')
-            }, status=500)
-        
-        # Convert graded images back to base64
-        graded_images_base64 = []
-        for img_bytes in result['graded_images']:
-            img_b64 = base64.b64encode(img_bytes).decode('utf-8')
-            graded_images_base64.append(f"data:image/jpeg;base64,{img_b64}")
-        
-        return JsonResponse({
-            'success': True,
-            'graded_images': graded_images_base64,
-            'grades': result['grades']
-        })
-        
+        # Shared grading agent (created once per process)
+        agent = _get_agent()
+
+        # Graded images go to media storage and only their URLs travel in
+        # the JSON, avoiding the 4/3 base64 inflation; ?format=inline keeps
+        # the data-URL behavior for API consumers that need it
+        inline = request.GET.get('format') == 'inline'
+
+        # Stream one NDJSON line per paper as soon as Gemini finishes it,
+        # instead of holding every graded image in memory for one big response
+        async def stream():
+            async for result in agent.grade_papers_stream(image_bytes_list, instructions):
+                if result['success']:
+                    payload = {
+                        'index': result['index'],
+                        'success': True,
+                        'grade': result['grade'],
+                        'feedback': result['feedback']
+                    }
+                    if inline:
+                        payload['graded_image'] = _encode_base64_image(result['image_bytes'])
+                    else:
+                        payload['graded_image_url'] = request.build_absolute_uri(
+                            _save_graded_image(result['image_bytes'])
+                        )
+                else:
+                    payload = {
+                        'index': result['index'],
+                        'success': False,
+                        'error': result['error']
+                    }
+                yield orjson.dumps(payload) + b'\n'
+
+        return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
     except Exception as e:
         return JsonResponse({
             'success': False,